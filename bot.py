@@ -1,16 +1,30 @@
 # bot.py
 import os
+import asyncio
+import bisect
+import functools
+import itertools
 import logging
+import mmap
 from logging.handlers import RotatingFileHandler
 from io import BytesIO
-from datetime import datetime
-from typing import List, Any
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import List, Any, Iterator, Tuple
 from dotenv import load_dotenv
 import pathlib
+import re
+import tempfile
+import threading
+import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
 
 import openpyxl
 import xlrd
+import xlsxwriter
 from rapidfuzz import process, fuzz
 
 from telegram import Update
@@ -22,6 +36,7 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     PicklePersistence,
+    PersistenceInput,
 )
 
 # Load local .env for dev if present
@@ -35,8 +50,21 @@ PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE", "bot_data.pkl")
 UPLOAD_MAX_MB = int(os.getenv("UPLOAD_MAX_MB", "8"))  # max upload size in MB
 UPLOAD_MAX_BYTES = UPLOAD_MAX_MB * 1024 * 1024
 MAX_ROWS = int(os.getenv("MAX_ROWS", "200000"))  # protect from enormous sheets
+OUTPUT_SPOOL_MAX_MB = int(os.getenv("OUTPUT_SPOOL_MAX_MB", "8"))  # filtered output kept in RAM up to this size
 LOG_FILE = os.getenv("LOG_FILE", "bot.log")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # optional secret for webhook path
+COLUMN_CACHE_SIZE = int(os.getenv("COLUMN_CACHE_SIZE", "16"))  # normalized search columns kept in memory
+# Parsed cells kept between steps, per process: roughly 30-100 bytes RSS per cell
+# (interned repeats at the low end, unique text/floats at the high end)
+SHEET_CACHE_CELLS = int(os.getenv("SHEET_CACHE_CELLS", "100000"))
+KNOWN_UPLOADS_SIZE = int(os.getenv("KNOWN_UPLOADS_SIZE", "32"))  # re-sent files reused without download
+KNOWN_UPLOADS_TTL = int(os.getenv("KNOWN_UPLOADS_TTL", "3600"))  # seconds a saved upload is reused for
+ASYNC_WORKERS = int(os.getenv("ASYNC_WORKERS", "4"))  # threads for parsing/filtering uploads
+PARSE_PROCESSES = int(os.getenv("PARSE_PROCESSES", "0"))  # >0: inspect uploads in this many processes
+# Bot API HTTP client overrides; unset keeps PTB's defaults (256-connection keep-alive pool)
+CONNECTION_POOL_SIZE = os.getenv("CONNECTION_POOL_SIZE")
+CONNECT_TIMEOUT = os.getenv("CONNECT_TIMEOUT")
+READ_TIMEOUT = os.getenv("READ_TIMEOUT")
 
 # Ensure upload dir exists
 pathlib.Path(UPLOAD_DIR).mkdir(parents=True, exist_ok=True)
@@ -47,16 +75,22 @@ pathlib.Path(UPLOAD_DIR).mkdir(parents=True, exist_ok=True)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# Console handler (already configured by basicConfig below for compatibility)
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
+def setup_logging() -> None:
+    """
+    Attach the console and rotating file handlers. Called by the bot process only:
+    parse processes re-import this module, and several processes rotating one
+    log file would lose lines.
+    """
+    # Console handler (already configured by basicConfig below for compatibility)
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO
+    )
 
-# Rotating file handler
-file_handler = RotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3)
-file_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
-logger.addHandler(file_handler)
+    # Rotating file handler
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    logger.addHandler(file_handler)
 
 # Conversation states
 WAITING_FILE, WAITING_COLUMN, WAITING_QUERY, WAITING_SELECT = range(4)
@@ -87,6 +121,28 @@ def format_number_no_scientific(v: Any) -> str:
             return format(v, "f").rstrip("0").rstrip(".")
     return str(v)
 
+# Text date formats tried in order; built once instead of on every call
+_DATE_FORMATS = (
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d",
+    "%d-%m-%Y",
+    "%d/%m/%Y",
+    "%Y/%m/%d",
+    "%d-%b-%Y",
+    "%d %b %Y",
+    "%m/%d/%Y",
+    "%Y.%m.%d %H:%M:%S",
+    "%Y.%m.%d",
+)
+
+# One precompiled shape check covering every format above: digits, separator,
+# day/month/month-name, separator, digits, optional H:M:S. Strings that fail it
+# cannot parse with any of them, so they skip all ten strptime attempts.
+_DATE_SHAPE_RE = re.compile(r"\d+(?:\s*[-/.]\s*|\s+)\w+(?:\s*[-/.]\s*|\s+)\d+(?:\s+\d+:\d+:\d+)?")
+
+# Excel 1900 date system epoch for serials >= 60 (after its fake 1900-02-29)
+_EXCEL_EPOCH = datetime(1899, 12, 30)
+
 def parse_possible_date(value: Any):
     if value is None:
         return None
@@ -94,48 +150,66 @@ def parse_possible_date(value: Any):
     if isinstance(value, datetime):
         return value
 
+    if isinstance(value, (int, float)):
+        if 1000 < value < 100000:
+            # Same result as xlrd.xldate.xldate_as_datetime(value, 0), without the
+            # per-call epoch selection and exception handling
+            days = int(value)
+            ms = int(round((value - days) * 86400000.0))
+            return _EXCEL_EPOCH + timedelta(days, ms // 1000, 0, ms % 1000)
+
+    if isinstance(value, str):
+        return _parse_date_text(value.strip())
+
+    return None
+
+def _parse_date_text(s: str):
+    if _DATE_SHAPE_RE.fullmatch(s):
+        parsed = _parse_date_shaped(s)
+        if parsed is not None:
+            return parsed
+
     try:
-        if isinstance(value, (int, float)):
-            if 1000 < value < 100000:
-                try:
-                    dt = xlrd.xldate.xldate_as_datetime(value, 0)
-                    return dt
-                except Exception:
-                    pass
+        if "t" in s.lower():
+            return datetime.fromisoformat(s)
     except Exception:
         pass
 
-    if isinstance(value, str):
-        s = value.strip()
-        fmts = [
-            "%Y-%m-%d %H:%M:%S",
-            "%Y-%m-%d",
-            "%d-%m-%Y",
-            "%d/%m/%Y",
-            "%Y/%m/%d",
-            "%d-%b-%Y",
-            "%d %b %Y",
-            "%m/%d/%Y",
-            "%Y.%m.%d %H:%M:%S",
-            "%Y.%m.%d"
-        ]
-        for f in fmts:
-            try:
-                return datetime.strptime(s, f)
-            except Exception:
-                continue
+    return None
 
+@functools.lru_cache(maxsize=8192)
+def _parse_date_shaped(s: str):
+    # Memoized: sheets repeat the same date strings across rows and uploads.
+    # Only date-shaped text gets here, so names and addresses are never cached.
+    for f in _DATE_FORMATS:
         try:
-            if "t" in s.lower():
-                return datetime.fromisoformat(s)
+            return datetime.strptime(s, f)
         except Exception:
-            pass
+            continue
+    return None
 
+def _format_none(value: None):
     return None
 
-def format_cell_for_output(value: Any):
-    if value is None:
-        return None
+def _format_datetime(value: datetime) -> str:
+    return value.strftime("%d-%m-%Y")
+
+def _format_float(value: float) -> str:
+    if value.is_integer():
+        return str(int(value))
+    possible_date = parse_possible_date(value)
+    if possible_date:
+        return possible_date.strftime("%d-%m-%Y")
+    return str(value)
+
+def _format_str(value: str) -> str:
+    possible_date = parse_possible_date(value)
+    if possible_date:
+        return possible_date.strftime("%d-%m-%Y")
+    return value.strip()
+
+def _format_other(value: Any):
+    # Generic path for subclasses (bool, numpy scalars, ...) and rare types
     if isinstance(value, datetime):
         return value.strftime("%d-%m-%Y")
     if isinstance(value, (int, float)) and is_integer_like_number(value):
@@ -147,59 +221,482 @@ def format_cell_for_output(value: Any):
         return value.strip()
     return str(value)
 
-def load_excel_clean_from_bytes(file_bytes: bytes, file_name: str) -> openpyxl.Workbook:
+# Exact-type dispatch: one dict lookup per cell instead of an isinstance chain
+_OUTPUT_FORMATTERS = {
+    type(None): _format_none,
+    str: _format_str,
+    int: str,
+    float: _format_float,
+    datetime: _format_datetime,
+}
+
+def format_cell_for_output(value: Any, _get=_OUTPUT_FORMATTERS.get):
+    return _get(type(value), _format_other)(value)
+
+def format_rows_for_output(rows: List[List[Any]]) -> List[List[Any]]:
+    """
+    Format raw rows column by column. Each distinct value in a column is
+    formatted once and the rest are dict lookups, so repeated dates, codes
+    and names skip the strptime/strftime work. Short rows come back padded
+    with None to the widest row.
+    """
+    formatted_cols = []
+    for col in itertools.zip_longest(*rows):
+        formatted = {v: format_cell_for_output(v) for v in dict.fromkeys(col)}
+        formatted_cols.append(map(formatted.__getitem__, col))
+    return [list(r) for r in zip(*formatted_cols)]
+
+def intern_column_strings(rows):
+    """
+    Yield rows where equal strings within a column share one str object.
+    Low-cardinality columns (cities, categories) then cost one allocation
+    per distinct value instead of one per cell.
+    """
+    pools: List[dict] = []
+    for row in rows:
+        if len(row) > len(pools):
+            pools.extend({} for _ in range(len(row) - len(pools)))
+        yield [pools[i].setdefault(v, v) if type(v) is str else v
+               for i, v in enumerate(row)]
+
+def _iter_xlsx_rows(file_path: str) -> Iterator[tuple]:
+    # read_only streams the sheet XML row by row instead of building the cell graph;
+    # keep_links=False skips parsing external-link parts we never use.
+    # zipfile reads the mapped file straight from the page cache; going through a
+    # file object rather than the path also accepts xlsx content named .xls
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        wb = openpyxl.load_workbook(mm, read_only=True, data_only=True, keep_links=False)
+        try:
+            ws = wb.active
+            # read_only clips every row to the recorded <dimension>, which some writers
+            # leave stale (e.g. "A1"). Stream the real extent instead, still padding
+            # short rows to the recorded width as before.
+            width = ws.max_column or 0
+            ws.reset_dimensions()
+            for row in ws.iter_rows(values_only=True):
+                if len(row) < width:
+                    row += (None,) * (width - len(row))
+                yield row
+        finally:
+            wb.close()
+
+def _iter_xls_rows(file_path: str) -> Iterator[list]:
+    try:
+        # on_demand: only the first sheet is parsed, other sheets are never loaded.
+        # Given a path, xlrd mmaps the file instead of reading it into memory.
+        book = xlrd.open_workbook(file_path, on_demand=True)
+    except xlrd.biffh.XLRDError as e:
+        if "xlsx file; not supported" in str(e).lower():
+            yield from _iter_xlsx_rows(file_path)
+            return
+        raise
+
+    try:
+        sheet = book.sheet_by_index(0)
+        for r in range(sheet.nrows):
+            yield sheet.row_values(r)
+    finally:
+        book.release_resources()
+
+def load_excel_clean(file_path: str, file_name: str) -> Tuple[List[Any], Iterator[List[Any]]]:
     """
-    Load workbook from bytes and return a clean openpyxl Workbook containing values-only.
+    Open the first sheet of a saved upload values-only.
+    Returns (header, rows): the header row and a lazy iterator over the
+    remaining rows, so callers hold one row at a time instead of the sheet.
     """
     lower = file_name.lower()
     if lower.endswith(".xlsx"):
-        wb = openpyxl.load_workbook(BytesIO(file_bytes), data_only=True)
-        ws = wb.active
-        clean_wb = openpyxl.Workbook()
-        clean_ws = clean_wb.active
-        for row in ws.iter_rows(values_only=True):
-            clean_ws.append([cell for cell in row])
-        return clean_wb
-
-    if lower.endswith(".xls"):
-        try:
-            book = xlrd.open_workbook(file_contents=file_bytes)
-            sheet = book.sheet_by_index(0)
-            clean_wb = openpyxl.Workbook()
-            clean_ws = clean_wb.active
-            for r in range(sheet.nrows):
-                clean_ws.append(sheet.row_values(r))
-            return clean_wb
-
-        except xlrd.biffh.XLRDError as e:
-            if "xlsx file; not supported" in str(e).lower():
-                wb = openpyxl.load_workbook(BytesIO(file_bytes), data_only=True)
-                ws = wb.active
-                clean_wb = openpyxl.Workbook()
-                clean_ws = clean_wb.active
-                for row in ws.iter_rows(values_only=True):
-                    clean_ws.append([cell for cell in row])
-                return clean_wb
-            raise
+        rows = _iter_xlsx_rows(file_path)
+    elif lower.endswith(".xls"):
+        rows = _iter_xls_rows(file_path)
+    else:
+        raise ValueError("Unsupported file type. Send .xls or .xlsx")
+
+    rows = intern_column_strings(rows)
+    header = next(rows, [])
+    return header, rows
+
+def read_sheet_outline(file_path: str, file_name: str):
+    """
+    Return (header, nrows, ncols) for the first sheet of a saved .xls upload,
+    parsing only the header row, or None when the upload holds xlsx content.
+    xls records its size reliably; an xlsx <dimension> can be stale, so xlsx
+    sheets are always streamed instead.
+    """
+    lower = file_name.lower()
+    if lower.endswith(".xlsx"):
+        return None
+    if not lower.endswith(".xls"):
+        raise ValueError("Unsupported file type. Send .xls or .xlsx")
 
-    raise ValueError("Unsupported file type. Send .xls or .xlsx")
+    try:
+        book = xlrd.open_workbook(file_path, on_demand=True)
+    except xlrd.biffh.XLRDError as e:
+        if "xlsx file; not supported" in str(e).lower():
+            return None
+        raise
 
-def save_uploaded_file(bytes_data: bytes, original_name: str) -> str:
+    try:
+        sheet = book.sheet_by_index(0)
+        header = sheet.row_values(0) if sheet.nrows else []
+        return header, sheet.nrows, sheet.ncols
+    finally:
+        book.release_resources()
+
+# Parsed sheets keyed by file_path, LRU-evicted to stay within SHEET_CACHE_CELLS.
+# Process-local like the column cache below.
+_sheet_cache: "OrderedDict[str, Tuple[List[Any], List[List[Any]], int]]" = OrderedDict()
+_sheet_cache_cells = 0
+_sheet_cache_lock = threading.Lock()
+
+def open_saved_sheet(file_path: str, file_name: str) -> Tuple[List[Any], Iterator[List[Any]]]:
+    """
+    Return (header, rows) for the first sheet of a saved upload, like
+    load_excel_clean. A sheet read to the end is kept in memory if it
+    fits SHEET_CACHE_CELLS, so picking a column and then a value parse the
+    file once instead of twice.
+    """
+    with _sheet_cache_lock:
+        cached = _sheet_cache.get(file_path)
+        if cached is not None:
+            _sheet_cache.move_to_end(file_path)
+            return cached[0], iter(cached[1])
+
+    header, rows = load_excel_clean(file_path, file_name)
+    return header, _cache_rows_while_reading(file_path, header, rows)
+
+def _cache_rows_while_reading(file_path: str, header: List[Any], rows: Iterator[List[Any]]) -> Iterator[List[Any]]:
+    global _sheet_cache_cells
+    kept = []
+    cells = len(header)
+    for row in rows:
+        if kept is not None:
+            cells += len(row)
+            # Too big to keep: stop collecting but keep streaming
+            if cells > SHEET_CACHE_CELLS:
+                kept = None
+            else:
+                kept.append(row)
+        yield row
+
+    if kept is None:
+        return
+    with _sheet_cache_lock:
+        if file_path in _sheet_cache:
+            return
+        _sheet_cache[file_path] = (header, kept, cells)
+        _sheet_cache_cells += cells
+        while _sheet_cache_cells > SHEET_CACHE_CELLS:
+            _, (_, _, evicted) = _sheet_cache.popitem(last=False)
+            _sheet_cache_cells -= evicted
+
+# Normalized search columns keyed by (file_path, col). Process-local on purpose:
+# user_data is pickled by PicklePersistence and must stay lightweight.
+_column_cache: "OrderedDict[Tuple[str, int], dict]" = OrderedDict()
+_column_cache_lock = threading.Lock()  # handlers build columns from worker threads
+
+# Cells never contain NUL (xlsx forbids it), so it safely separates them in the joined buffer
+_CELL_SEP = "\x00"
+
+def get_search_column(file_path: str, file_name: str, col: int) -> dict:
+    """
+    Return the dictionary-encoded search data for one column of the saved upload:
+      keys   - distinct casefolded stripped values, in first-seen order ("" for empty cells)
+      labels - first original spelling (stripped) of each key
+      rows   - per key, the ascending data-row indices holding that value
+      joined - keys joined with NUL into one string for C-level find()
+      starts - offset of each key inside joined
+    Repeated values are stored once, so memory and search cost scale with the
+    number of distinct values rather than rows. Built once per column, then
+    served from an LRU cache.
+    """
+    key = (file_path, col)
+    with _column_cache_lock:
+        cached = _column_cache.get(key)
+        if cached is not None:
+            _column_cache.move_to_end(key)
+            return cached
+
+    _header, rows = open_saved_sheet(file_path, file_name)
+    keys: List[str] = []
+    labels: List[str] = []
+    postings: List[array] = []
+    key_index = {}
+    # Text cells repeat: map each raw string to its key once and skip the
+    # strip/casefold on every later occurrence
+    str_index = {}
+    for i, row in enumerate(rows):
+        raw = row[col - 1] if col <= len(row) else None
+        is_str = type(raw) is str
+        k = str_index.get(raw) if is_str else None
+        if k is None:
+            if is_str:
+                text = raw.strip()
+            else:
+                text = "" if raw is None else str(raw).strip()
+            norm = text.casefold()
+            k = key_index.get(norm)
+            if k is None:
+                k = key_index[norm] = len(keys)
+                keys.append(norm)
+                labels.append(text)
+                postings.append(array("I"))
+            if is_str:
+                str_index[raw] = k
+        postings[k].append(i)
+
+    starts = []
+    offset = 0
+    for norm in keys:
+        starts.append(offset)
+        offset += len(norm) + 1
+
+    column = {
+        "keys": keys,
+        "labels": labels,
+        "rows": postings,
+        "joined": _CELL_SEP.join(keys),
+        "starts": starts,
+    }
+    with _column_cache_lock:
+        _column_cache[key] = column
+        while len(_column_cache) > COLUMN_CACHE_SIZE:
+            _column_cache.popitem(last=False)
+    return column
+
+def find_matching_keys(column: dict, needle: str) -> List[int]:
+    """
+    Return indices into column["keys"] of the values containing needle (already casefolded).
+    Scans the joined keys with str.find, so the cost is one C-level search
+    per hit instead of one Python-level test per value.
+    """
+    if not needle:
+        return []
+    if _CELL_SEP in needle:
+        return [k for k, norm in enumerate(column["keys"]) if needle in norm]
+
+    joined = column["joined"]
+    starts = column["starts"]
+    last_key = len(starts) - 1
+    hits = []
+    pos = joined.find(needle)
+    while pos != -1:
+        k = bisect.bisect_right(starts, pos) - 1
+        hits.append(k)
+        if k == last_key:
+            break
+        # Resume at the next value so each one is reported once
+        pos = joined.find(needle, starts[k + 1])
+    return hits
+
+def inspect_upload(file_path: str, file_name: str, open_sheet=open_saved_sheet) -> Tuple[List[Any], bool, int]:
+    """
+    Return (header, oversized, max_col) for the first sheet of a saved upload;
+    oversized means more than MAX_ROWS data rows. The header is padded with
+    None to max_col, so it is empty only for a sheet without any cells.
+    An xls within the limit only has its header row parsed. Anything else is
+    streamed once with open_sheet, stopping just past MAX_ROWS.
+    """
+    outline = read_sheet_outline(file_path, file_name)
+    if outline is not None:
+        header, nrows, ncols = outline
+        # xlrd never yields rows past nrows/ncols, so within the limit this is exact
+        if nrows - 1 <= MAX_ROWS:
+            max_col = max(ncols, len(header)) if nrows else 0
+            return header + [None] * (max_col - len(header)), False, max_col
+
+    header, rows = open_sheet(file_path, file_name)
+    max_col = len(header)
+    row_count = 0
+    for row in rows:
+        row_count += 1
+        if row_count > MAX_ROWS:
+            break
+        if len(row) > max_col:
+            max_col = len(row)
+    # A blank first row streams as an empty header; data further down still counts
+    return header + [None] * (max_col - len(header)), row_count > MAX_ROWS, max_col
+
+# Matched rows read, formatted and written per batch when building the output
+_WRITE_CHUNK_ROWS = 1024
+
+def write_filtered_workbook(output, file_path: str, file_name: str, col: int, chosen_key: str, max_col: int) -> int:
+    """
+    Write a "Filtered" xlsx to the binary file object `output` holding the header
+    and every data row whose column col contains chosen_key (casefolded).
+    Rows stream from the file into the workbook in small batches, so peak memory
+    no longer grows with the number of matches. Returns the number of rows written.
+    """
+    # Match against the cached normalized column, then pull just those rows from the file
+    column = get_search_column(file_path, file_name, col)
+    matched = find_matching_keys(column, chosen_key)
+    if not matched:
+        return 0
+
+    # Row indices come straight from the per-value index: O(matches), no row scan.
+    # The mask stops at the last hit, so compress() stops reading the file there too.
+    postings = column["rows"]
+    last = max(postings[k][-1] for k in matched)
+    mask = bytearray(last + 1)
+    for k in matched:
+        for i in postings[k]:
+            mask[i] = 1
+
+    header, rows = open_saved_sheet(file_path, file_name)
+    header_row = [str(v) if v else "" for v in header]
+    header_row += [""] * (max_col - len(header_row))
+    ncols = len(header_row)
+
+    out_wb = xlsxwriter.Workbook(output, {
+        "constant_memory": True,
+        # Cells are already text; write them verbatim, never as formulas/links/numbers
+        "strings_to_formulas": False,
+        "strings_to_urls": False,
+        "strings_to_numbers": False,
+    })
+    out_ws = out_wb.add_worksheet("Filtered")
+    out_ws.write_row(0, 0, header_row)
+
+    # Work in chunks of matched rows: memory stays bounded by the chunk, while
+    # formatting and measuring stay column-wise over each chunk's distinct values.
+    # Keeping the reading and writing phases apart is also measurably faster
+    # than alternating them row by row.
+    max_lens = [len(v) for v in header_row]
+    matched_rows = itertools.compress(rows, mask)
+    written = 0
+    while True:
+        chunk = list(itertools.islice(matched_rows, _WRITE_CHUNK_ROWS))
+        if not chunk:
+            break
+        chunk = format_rows_for_output(chunk)
+        for c, cells in enumerate(itertools.islice(zip(*chunk), ncols)):
+            # Formatted cells are str or None
+            n = max(map(len, filter(None, set(cells))), default=0)
+            if n > max_lens[c]:
+                max_lens[c] = n
+        for row in chunk:
+            written += 1
+            out_ws.write_row(written, 0, row)
+
+    # constant_memory writes the <cols> widths at close, so they can be set last
+    for c, max_len in enumerate(max_lens):
+        out_ws.set_column(c, c, min(max(max_len + 2, 12), 60))
+    out_wb.close()
+    return written
+
+def build_template_workbook(columns: List[str]) -> BytesIO:
+    """
+    Return an in-memory xlsx whose only row holds the given column names.
     """
-    Save uploaded file bytes to UPLOAD_DIR and return path.
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "Sheet1"
+    ws.append(columns)
+
+    output = BytesIO()
+    wb.save(output)
+    output.seek(0)
+    return output
+
+def new_upload_path(original_name: str) -> str:
+    """
+    Return a fresh path in UPLOAD_DIR for an upload.
     Filename uses uuid to avoid collisions.
     """
     uid = uuid.uuid4().hex
     safe_name = "".join(c for c in original_name if c.isalnum() or c in "._- ")[:100]
     filename = f"{uid}_{safe_name}"
-    path = os.path.join(UPLOAD_DIR, filename)
-    with open(path, "wb") as f:
-        f.write(bytes_data)
-    return path
+    return os.path.join(UPLOAD_DIR, filename)
+
+# Accepted uploads keyed by Telegram's file_unique_id, which stays the same when a
+# file is forwarded or sent again. Each entry is (saved_path, header, max_col, accepted_at).
+# Only touched from handlers on the event loop.
+_known_uploads: "OrderedDict[str, Tuple[str, List[Any], int, float]]" = OrderedDict()
+
+def find_known_upload(file_unique_id: str):
+    """
+    Return (saved_path, header, max_col) for a file accepted less than
+    KNOWN_UPLOADS_TTL seconds ago, or None.
+    """
+    known = _known_uploads.get(file_unique_id)
+    if known is None:
+        return None
+    saved_path, header, max_col, accepted_at = known
+    # Past the TTL the saved copy may have been cleaned up or replaced: download again
+    if time.monotonic() - accepted_at > KNOWN_UPLOADS_TTL or not os.path.exists(saved_path):
+        del _known_uploads[file_unique_id]
+        return None
+    _known_uploads.move_to_end(file_unique_id)
+    return saved_path, header, max_col
+
+def remember_upload(file_unique_id: str, saved_path: str, header: List[Any], max_col: int) -> None:
+    _known_uploads[file_unique_id] = (saved_path, header, max_col, time.monotonic())
+    while len(_known_uploads) > KNOWN_UPLOADS_SIZE:
+        _known_uploads.popitem(last=False)
+
+def discard_upload(path: str) -> None:
+    try:
+        os.remove(path)
+    except Exception:
+        logger.exception("Failed to remove rejected upload: %s", path)
+
+# Parsing and filtering run on their own bounded pool, so a burst of large uploads
+# queues here instead of also starving the loop's default executor
+_blocking_pool = ThreadPoolExecutor(max_workers=ASYNC_WORKERS, thread_name_prefix="excel-worker")
+
+async def run_blocking(func, *args):
+    """Run a blocking helper on the worker pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_blocking_pool, func, *args)
+
+# Optional process pool for pure, picklable parsing (bytes in, small tuple out).
+# Threads share the GIL, so on multi-core hosts this lets uploads parse in parallel.
+# spawn avoids forking a process that already runs the event loop and worker threads.
+_parse_pool = (
+    ProcessPoolExecutor(max_workers=PARSE_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    if PARSE_PROCESSES > 0 else None
+)
+
+async def run_parse(func, *args):
+    """Run a picklable parsing helper in the process pool if enabled, else on the worker threads."""
+    if _parse_pool is None:
+        return await run_blocking(func, *args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_parse_pool, func, *args)
+
+# -------------------------
+# Non-blocking conversation support
+# -------------------------
+# The filter conversation runs its steps as tasks (block=False). While one is still
+# running, PTB only offers the user's updates to the WAITING handlers below and
+# ignores the state they return, so /cancel is recorded here and applied by the
+# step itself once it finishes.
+def honor_cancel(callback):
+    """Wrap a conversation step so a /cancel sent while it ran ends the conversation."""
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        context.user_data.pop("cancel_requested", None)
+        state = await callback(update, context)
+        if context.user_data.pop("cancel_requested", False):
+            return ConversationHandler.END
+        return state
+    return wrapper
+
+async def cancel_while_busy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["cancel_requested"] = True
+    await update.effective_message.reply_text(
+        "Still working on your file. The operation will be cancelled as soon as this step finishes."
+    )
+
+async def still_busy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.effective_message.reply_text(
+        "Still working on your file. Please wait for my reply, then send that again (or /cancel)."
+    )
 
 # -------------------------
 # Handlers (preserve your original flows)
 # -------------------------
+@honor_cancel
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Send an Excel file (.xls or .xlsx). I'll strip formatting and work with values-only.\n\n"
@@ -213,7 +710,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return WAITING_FILE
 
+@honor_cancel
 async def receive_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    pending_path = None  # downloaded but not yet accepted; removed if anything fails
     try:
         doc = update.message.document
         if not doc:
@@ -234,36 +733,49 @@ async def receive_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Please send only .xls or .xlsx files.")
             return WAITING_FILE
 
-        tgfile = await context.bot.get_file(doc.file_id)
-        fb = await tgfile.download_as_bytearray()
-
-        # Save raw uploaded bytes to persistent upload dir and record path in user_data
-        saved_path = save_uploaded_file(bytes(fb), fname)
-
-        # Load workbook values-only to inspect columns/rows and enforce row limits
-        wb = load_excel_clean_from_bytes(bytes(fb), fname)
-        ws = wb.active
-
-        if ws.max_row - 1 > MAX_ROWS:  # subtract header row
-            await update.message.reply_text(
-                f"Workbook has {ws.max_row - 1} data rows, exceeds limit of {MAX_ROWS}. "
-                "Please upload a smaller file."
-            )
-            # Optionally remove saved file to avoid storing huge uploads
-            try:
-                os.remove(saved_path)
-            except Exception:
-                logger.exception("Failed to remove oversized uploaded file: %s", saved_path)
-            return WAITING_FILE
+        # The same file sent again: reuse the saved copy (and its cached sheet and
+        # columns) instead of downloading and parsing it another time
+        unique_id = getattr(doc, "file_unique_id", None)
+        known = find_known_upload(unique_id) if unique_id else None
+        if known:
+            saved_path, header, max_col = known
+        else:
+            tgfile = await context.bot.get_file(doc.file_id)
+            # Stream the download straight into the persistent upload dir: the file is
+            # never held in memory, and the parsers read it from disk as needed
+            saved_path = new_upload_path(fname)
+            pending_path = saved_path
+            await tgfile.download_to_drive(saved_path)
+
+            # Parsing is CPU-bound: run it in a worker thread so other chats keep being served.
+            # A parse process skips the sheet cache, which this process could never read.
+            open_sheet = open_saved_sheet if _parse_pool is None else load_excel_clean
+            header, oversized, max_col = await run_parse(inspect_upload, saved_path, fname, open_sheet)
+            if not header:
+                await update.message.reply_text("The first sheet is empty. Please upload a file with data.")
+                discard_upload(saved_path)
+                return WAITING_FILE
+
+            if oversized:
+                await update.message.reply_text(
+                    f"Workbook exceeds the limit of {MAX_ROWS} data rows. "
+                    "Please upload a smaller file."
+                )
+                discard_upload(saved_path)
+                return WAITING_FILE
+
+            pending_path = None
+            if unique_id:
+                remember_upload(unique_id, saved_path, header, max_col)
 
         # Persist only lightweight info (do NOT put workbook objects in user_data)
         context.user_data["file_path"] = saved_path
         context.user_data["file_name"] = fname
-        context.user_data["max_col"] = ws.max_column
+        context.user_data["max_col"] = max_col
 
         headers = []
-        for col in range(1, ws.max_column + 1):
-            v = ws.cell(1, col).value
+        for col in range(1, max_col + 1):
+            v = header[col - 1] if col <= len(header) else None
             if v is None:
                 headers.append(f"{col}. Column {openpyxl.utils.get_column_letter(col)}")
             else:
@@ -271,15 +783,18 @@ async def receive_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         await update.message.reply_text(
             "File loaded. Columns:\n\n" + "\n".join(headers) +
-            f"\n\nReply with column number (1 - {ws.max_column})."
+            f"\n\nReply with column number (1 - {max_col})."
         )
         return WAITING_COLUMN
 
     except Exception as e:
         logger.exception("Error in receive_file")
+        if pending_path and os.path.exists(pending_path):
+            discard_upload(pending_path)
         await update.message.reply_text("Error while processing file. Make sure it's a valid .xls or .xlsx.")
         return WAITING_FILE
 
+@honor_cancel
 async def receive_column(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = update.message.text.strip()
     try:
@@ -297,9 +812,16 @@ async def receive_column(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return WAITING_COLUMN
 
     context.user_data["col"] = c
+
+    # Normalize the chosen column once; every query on it reuses the cached lists
+    file_path = context.user_data.get("file_path")
+    if file_path and os.path.exists(file_path):
+        await run_blocking(get_search_column, file_path, context.user_data.get("file_name", "file.xlsx"), c)
+
     await update.message.reply_text("Enter a search string.")
     return WAITING_QUERY
 
+@honor_cancel
 async def receive_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.message.text.strip()
     if not query:
@@ -311,37 +833,27 @@ async def receive_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Uploaded file not found (session expired). Please upload again.")
         return ConversationHandler.END
 
-    # Re-load workbook from saved file (safe; keeps user_data pickleable)
-    with open(file_path, "rb") as f:
-        wb = load_excel_clean_from_bytes(f.read(), context.user_data.get("file_name", "file.xlsx"))
-    ws = wb.active
     col = context.user_data.get("col")
     if not col:
         await update.message.reply_text("Column not selected. Start again (/start).")
         return ConversationHandler.END
 
-    seen = {}
-    for r in range(2, ws.max_row + 1):
-        raw = ws.cell(r, col).value
-        if raw is None:
-            continue
-        norm = str(raw).strip().lower()
-        if query.lower() in norm:
-            if norm not in seen:
-                seen[norm] = str(raw).strip()
+    column = await run_blocking(get_search_column, file_path, context.user_data.get("file_name", "file.xlsx"), col)
+    labels = column["labels"]
 
-    if not seen:
+    # Keys are already distinct and in first-seen order, so no second dedupe pass is needed
+    choices = [labels[k] for k in find_matching_keys(column, query.casefold())]
+
+    if not choices:
         await update.message.reply_text("No matches found.")
         return ConversationHandler.END
 
-    choices = list(seen.values())
-    ranked = process.extract(query, choices, scorer=fuzz.partial_ratio, limit=200)
-    ordered = [t[0] for t in ranked]
-
-    presented = ordered[:40]
+    # Only the top 40 are ever shown, so let rapidfuzz keep just those
+    ranked = process.extract(query, choices, scorer=fuzz.partial_ratio, limit=40)
+    presented = [t[0] for t in ranked]
     context.user_data["candidates"] = presented
 
-    lines = [f"Found {len(seen)} values. Showing top {len(presented)}:"]
+    lines = [f"Found {len(choices)} values. Showing top {len(presented)}:"]
     for i, v in enumerate(presented, 1):
         lines.append(f"{i}. {v}")
     lines.append("\nReply with number (0 to cancel).")
@@ -349,6 +861,7 @@ async def receive_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("\n".join(lines))
     return WAITING_SELECT
 
+@honor_cancel
 async def receive_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = update.message.text.strip()
     if not txt.isdigit():
@@ -373,59 +886,32 @@ async def receive_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Uploaded file not found (session expired). Please upload again.")
         return ConversationHandler.END
 
-    with open(file_path, "rb") as f:
-        wb = load_excel_clean_from_bytes(f.read(), context.user_data.get("file_name", "file.xlsx"))
-    ws = wb.active
+    file_name = context.user_data.get("file_name", "file.xlsx")
     col = context.user_data.get("col")
 
-    out_wb = openpyxl.Workbook()
-    out_ws = out_wb.active
-    out_ws.title = "Filtered"
-
-    header_row = []
-    for c in range(1, ws.max_column + 1):
-        v = ws.cell(1, c).value
-        header_row.append(str(v) if v else "")
-    out_ws.append(header_row)
-
-    match_count = 0
-    for r in range(2, ws.max_row + 1):
-        val = ws.cell(r, col).value
-        if val is None:
-            continue
-        if chosen.lower() in str(val).strip().lower():
-            formatted = [format_cell_for_output(ws.cell(r, c).value)
-                         for c in range(1, ws.max_column + 1)]
-            out_ws.append(formatted)
-            match_count += 1
-
-    if match_count == 0:
-        await update.message.reply_text("Unexpected: no rows matched.")
-        return ConversationHandler.END
-
-    for c in range(1, ws.max_column + 1):
-        letter = openpyxl.utils.get_column_letter(c)
-        max_len = 0
-        for row in out_ws.iter_rows(min_col=c, max_col=c):
-            for cell in row:
-                if cell.value:
-                    max_len = max(max_len, len(str(cell.value)))
-        out_ws.column_dimensions[letter].width = min(max(max_len + 2, 12), 60)
-
-    output = BytesIO()
-    out_wb.save(output)
-    output.seek(0)
-
     base = os.path.splitext(context.user_data.get("file_name", "filtered"))[0]
     # make filename safe
     chosen_safe = "".join(ch for ch in chosen[:30] if ch.isalnum() or ch in "._- ").replace(" ", "_")
     out_name = f"{base}_filtered_by_{col}_{chosen_safe}.xlsx"
 
-    await update.message.reply_document(
-        document=output,
-        filename=out_name,
-        caption=f"Filtered file ready. {match_count} rows matched."
-    )
+    # Spool the xlsx: small results stay in memory, large ones roll over to disk
+    with tempfile.SpooledTemporaryFile(max_size=OUTPUT_SPOOL_MAX_MB * 1024 * 1024) as output:
+        # Filtering and workbook building are CPU-bound: keep them off the event loop
+        match_count = await run_blocking(
+            write_filtered_workbook, output, file_path, file_name, col,
+            chosen.casefold(), context.user_data.get("max_col", 0))
+
+        if match_count == 0:
+            await update.message.reply_text("Unexpected: no rows matched.")
+            return ConversationHandler.END
+
+        output.seek(0)
+
+        await update.message.reply_document(
+            document=output,
+            filename=out_name,
+            caption=f"Filtered file ready. {match_count} rows matched."
+        )
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -450,14 +936,8 @@ async def receive_create_columns(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("Invalid column list.")
         return WAITING_CREATE_COLUMNS
 
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Sheet1"
-    ws.append(cols)
-
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
+    # Saving a workbook is synchronous zip/XML work: keep it off the event loop too
+    output = await run_blocking(build_template_workbook, cols)
 
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"empty_template_{timestamp}.xlsx"
@@ -487,9 +967,21 @@ async def global_error_handler(update: object, context: ContextTypes.DEFAULT_TYP
 # Main application: build handlers & start either polling or webhook
 # -------------------------
 def build_application(token: str) -> Application:
-    # Persistence for user_data, chat_data, bot_data
-    persistence = PicklePersistence(filepath=PERSISTENCE_FILE)
-    app = Application.builder().token(token).persistence(persistence).build()
+    # Persistence for user_data only: chat_data/bot_data/callback_data are unused,
+    # so skip pickling and flushing them on every update_interval
+    persistence = PicklePersistence(
+        filepath=PERSISTENCE_FILE,
+        store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+    )
+    builder = Application.builder().token(token).persistence(persistence)
+    # PTB already reuses pooled connections; only tune the client when asked to
+    if CONNECTION_POOL_SIZE:
+        builder = builder.connection_pool_size(int(CONNECTION_POOL_SIZE))
+    if CONNECT_TIMEOUT:
+        builder = builder.connect_timeout(float(CONNECT_TIMEOUT))
+    if READ_TIMEOUT:
+        builder = builder.read_timeout(float(READ_TIMEOUT))
+    app = builder.build()
 
     # Filtering workflow (original)
     filter_conv = ConversationHandler(
@@ -501,10 +993,17 @@ def build_application(token: str) -> Application:
             WAITING_FILE: [MessageHandler(filters.Document.ALL, receive_file)],
             WAITING_COLUMN: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_column)],
             WAITING_QUERY: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_query)],
-            WAITING_SELECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_select)]
+            WAITING_SELECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_select)],
+            # While a step is still running: answer instead of silently dropping the update
+            ConversationHandler.WAITING: [
+                CommandHandler("cancel", cancel_while_busy),
+                MessageHandler(filters.ALL, still_busy),
+            ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        # Non-blocking: a long upload/filter for one chat doesn't hold up everyone else's updates
+        block=False
     )
 
     create_conv = ConversationHandler(
@@ -533,6 +1032,7 @@ def build_application(token: str) -> Application:
     return app
 
 def main():
+    setup_logging()
     TOKEN = os.getenv("TOKEN")
     if not TOKEN:
         raise SystemExit("TOKEN not set in environment.")
@@ -1,17 +1,21 @@
 import os
 import asyncio
+import orjson
 from aiohttp import web
 from dotenv import load_dotenv
-from bot import application   # PTB Application instance
+from telegram import Update
+from bot import build_application, setup_logging
 
 load_dotenv()
 TOKEN = os.getenv("TOKEN")
+application = build_application(TOKEN)   # PTB Application instance
 
 # Telegram sends POST updates here
 async def handle_webhook(request):
     try:
-        data = await request.json()
-        await application.update_queue.put(data)
+        data = orjson.loads(await request.read())
+        # Ack right away; the application's own update fetcher dispatches it
+        await application.update_queue.put(Update.de_json(data, application.bot))
     except Exception as e:
         print("Webhook error:", e)
     return web.Response(text="OK")
@@ -25,6 +29,10 @@ async def start():
 
     webhook_url = f"https://{hostname}/webhook/{TOKEN}"
 
+    # Start PTB application (NO POLLING): its fetcher consumes update_queue
+    await application.initialize()
+    await application.start()
+
     # Remove old webhook
     await application.bot.delete_webhook(drop_pending_updates=True)
 
@@ -47,11 +55,16 @@ async def start():
     print("Listening on port:", port)
     print("=========================================")
 
-    # Start PTB application (NO POLLING)
-    await application.initialize()
-    await application.start()
-    await application.stop()  # never reached but required by PTB
+    try:
+        # Serve until the process is stopped
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await application.stop()
+        await application.shutdown()
 
 
 if __name__ == "__main__":
+    # Only here: parse processes re-import this module under another name
+    setup_logging()
     asyncio.run(start())